@@ -1,20 +1,28 @@
-import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from itertools import islice
+from operator import itemgetter
 
+import orjson
 
-def parse_trial_file(filename):
-    f = open(filename)
-    linex_indexes = f.readlines()
+SKIP_TOKENS = frozenset(('[CLS]', '[SEP]'))
+get_token = itemgetter('token')
 
-    for i in range(len(linex_indexes)):
-        linex_indexes[i] = json.loads(linex_indexes[i].strip())
 
-    print('linex index:', linex_indexes[0]['linex_index'])
-    print('len features:', len(linex_indexes[0]['features']))
-    print('token:', linex_indexes[0]['features'][0]['token'])
-    print('layers:', linex_indexes[0]['features'][0]['layers'])
-    print('layers values len:', len(linex_indexes[0]['features'][0]['layers'][0]['values']))
+def parse_trial_file(filename):
+    f = open(filename, 'rb')
+    # only the first sentence is inspected
+    linex_index = orjson.loads(f.readline())
+
+    print('linex index:', linex_index['linex_index'])
+    print('len features:', len(linex_index['features']))
+    print('token:', linex_index['features'][0]['token'])
+    print('layers:', linex_index['features'][0]['layers'])
+    print('layers values len:', len(linex_index['features'][0]['layers'][0]['values']))
     available_tokens = []
-    for feature in linex_indexes[0]['features']:
+    for feature in linex_index['features']:
         available_tokens.append(feature['token'])
     print('tokens:', available_tokens)
 
@@ -22,27 +30,14 @@ def parse_trial_file(filename):
 
 
 def prepare_alignment_file(src, tgt, with_hashtag):
-    f = open(src)
-    linex_indexes = f.readlines()
-
-    f_write = open(tgt, 'a')
+    f = open(src, 'rb', buffering=1 << 20)
+    f_write = open(tgt, 'w', buffering=1 << 20)
 
-    for i in range(len(linex_indexes)):
-        linex_indexes[i] = json.loads(linex_indexes[i].strip())
-
-    for linex_index in linex_indexes:
-        tokens = []
-
-        for feature in linex_index['features']:
-            token = feature['token']
-            if token != '[CLS]' and token != '[SEP]':
-                if with_hashtag:
-                    tokens.append(token)
-                else:
-                    if token.startswith('##'):
-                        tokens.append(token[2:])
-                    else:
-                        tokens.append(token)
+    for line in f:
+        tokens = [token for token in map(get_token, orjson.loads(line)['features'])
+                  if token not in SKIP_TOKENS]
+        if not with_hashtag:
+            tokens = [token[2:] if token[:2] == '##' else token for token in tokens]
 
         f_write.write(' '.join(tokens) + '\n')
 
@@ -60,7 +55,7 @@ def generate_alignment_file(src, tgt, filename):
     if len(src_lines) != len(tgt_lines):
         raise Exception(f'Length is not the same. Src: {len(src_lines)}. Tgt: {len(tgt_lines)}.')
 
-    f_res = open(filename, 'w')
+    f_res = open(filename, 'w', buffering=1 << 20)
 
     for i in range(len(src_lines)):
         f_res.write(src_lines[i].strip() + ' ||| ' + tgt_lines[i].strip() + '\n')
@@ -70,36 +65,86 @@ def generate_alignment_file(src, tgt, filename):
     f_res.close()
 
 
+def parse_tokens(line):
+    hashtag_tokens = [token for token in map(get_token, orjson.loads(line)['features'])
+                      if token not in SKIP_TOKENS]
+    tokens = [token[2:] if token[:2] == '##' else token for token in hashtag_tokens]
+
+    return ' '.join(tokens), ' '.join(hashtag_tokens)
+
+
+def parse_lines(lines):
+    return [parse_tokens(line) for line in lines]
+
+
+def read_line_chunks(f_src, f_tgt, chunk_size):
+    n_lines = 0
+    while True:
+        src_lines = list(islice(f_src, chunk_size))
+        tgt_lines = list(islice(f_tgt, chunk_size))
+        if len(src_lines) != len(tgt_lines):
+            n_src = n_lines + len(src_lines) + sum(1 for _ in f_src)
+            n_tgt = n_lines + len(tgt_lines) + sum(1 for _ in f_tgt)
+            raise Exception(f'Length is not the same. Src: {n_src}. Tgt: {n_tgt}.')
+        if not src_lines:
+            return
+        n_lines += len(src_lines)
+        yield src_lines, tgt_lines
+
+
+def prepare_and_align(src_bert, tgt_bert, src_raw, tgt_raw, filename, max_workers=2, chunk_size=256):
+    """
+    Single pass version of prepare_alignment_file + generate_alignment_file.
+    Each .bert line is parsed once and written to the raw file, its '.hashtag'
+    counterpart and the paired alignment files. Chunks of lines are parsed by
+    max_workers processes, with at most 2 * max_workers chunk pairs in flight.
+    Outputs are written to '.tmp' files which replace the targets only once the
+    whole input has been processed, a failed run leaves existing outputs as is.
+    """
+    outputs = [src_raw, src_raw + '.hashtag', tgt_raw, tgt_raw + '.hashtag', filename, filename + '.hashtag']
+
+    try:
+        with ExitStack() as stack:
+            f_src = stack.enter_context(open(src_bert, 'rb', buffering=1 << 20))
+            f_tgt = stack.enter_context(open(tgt_bert, 'rb', buffering=1 << 20))
+            f_src_raw, f_src_hashtag, f_tgt_raw, f_tgt_hashtag, f_res, f_res_hashtag = [
+                stack.enter_context(open(output + '.tmp', 'w', buffering=1 << 20)) for output in outputs]
+
+            def write_chunk(src_future, tgt_future):
+                for (src_text, src_hashtag_text), (tgt_text, tgt_hashtag_text) in zip(src_future.result(),
+                                                                                       tgt_future.result()):
+                    f_src_raw.write(src_text + '\n')
+                    f_src_hashtag.write(src_hashtag_text + '\n')
+                    f_tgt_raw.write(tgt_text + '\n')
+                    f_tgt_hashtag.write(tgt_hashtag_text + '\n')
+                    f_res.write(src_text + ' ||| ' + tgt_text + '\n')
+                    f_res_hashtag.write(src_hashtag_text + ' ||| ' + tgt_hashtag_text + '\n')
+
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                pending = deque()
+                for src_lines, tgt_lines in read_line_chunks(f_src, f_tgt, chunk_size):
+                    pending.append((executor.submit(parse_lines, src_lines), executor.submit(parse_lines, tgt_lines)))
+                    if len(pending) >= 2 * max_workers:
+                        write_chunk(*pending.popleft())
+                while pending:
+                    write_chunk(*pending.popleft())
+    except BaseException:
+        for output in outputs:
+            if os.path.exists(output + '.tmp'):
+                os.remove(output + '.tmp')
+        raise
+
+    for output in outputs:
+        os.replace(output + '.tmp', output)
+
+
 if __name__ == '__main__':
     # parse_trial_file('trial_data/de-en.100.en.bert')
     # parse_trial_file('trial_data/de-en.100.de.bert')
-    prepare_alignment_file(
-        src='trial_data/de-en.100.de.bert',
-        tgt='trial_data/de.raw',
-        with_hashtag=False
-    )
-    prepare_alignment_file(
-        src='trial_data/de-en.100.de.bert',
-        tgt='trial_data/de.raw.hashtag',
-        with_hashtag=True
-    )
-    prepare_alignment_file(
-        src='trial_data/de-en.100.en.bert',
-        tgt='trial_data/en.raw',
-        with_hashtag=False
-    )
-    prepare_alignment_file(
-        src='trial_data/de-en.100.en.bert',
-        tgt='trial_data/en.raw.hashtag',
-        with_hashtag=True
-    )
-    generate_alignment_file(
-        src='trial_data/de.raw',
-        tgt='trial_data/en.raw',
+    prepare_and_align(
+        src_bert='trial_data/de-en.100.de.bert',
+        tgt_bert='trial_data/de-en.100.en.bert',
+        src_raw='trial_data/de.raw',
+        tgt_raw='trial_data/en.raw',
         filename='trial_data/text.de-en.100.uncased'
     )
-    generate_alignment_file(
-        src='trial_data/de.raw.hashtag',
-        tgt='trial_data/en.raw.hashtag',
-        filename='trial_data/text.de-en.100.uncased.hashtag'
-    )
@@ -10,7 +10,7 @@ import torch
 from torch import nn
 
 from src.utils import load_embeddings, normalize_embeddings
-from src.bert_modeling import BertConfig, BertModel
+from src.bert_modeling import BertConfig, BertModel, BERTLayerNorm
 from src.maps import NonLinearMap, SelfAttentionMap, AttentionMap, LinearSelfAttentionMap, NonLinearSelfAttentionMap
 
 logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s', 
@@ -45,6 +45,17 @@ class Discriminator(nn.Module):
         return self.layers(x).view(-1)
 
 
+def half_bert(model):
+    """
+    Convert a BERT model to half precision, keeping its LayerNorms in fp32.
+    """
+    model.half()
+    for module in model.modules():
+        if isinstance(module, BERTLayerNorm):
+            module.float()
+    return model
+
+
 def build_model(args, with_dis):
     """
     Build all components of the model.
@@ -56,6 +67,7 @@ def build_model(args, with_dis):
     else:
         device = torch.device("cuda", args.local_rank)
         n_gpu = 1
+        torch.cuda.set_device(args.local_rank)
         # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
         torch.distributed.init_process_group(backend='nccl')
     print("device", device, "n_gpu", n_gpu, "distributed training", bool(args.local_rank != -1))
@@ -68,16 +80,27 @@ def build_model(args, with_dis):
         bert_config = BertConfig.from_json_file(args.bert_config_file)
         model = BertModel(bert_config)
         if args.init_checkpoint is not None:
-            model.load_state_dict(torch.load(args.init_checkpoint, map_location='cpu'))
+            state = torch.load(args.init_checkpoint, map_location='cpu')
+            model.load_state_dict(state)
+            # free the CPU copy of the checkpoint before loading the next one
+            del state
         model.to(device)
 
         if args.bert_config_file1: 
             bert_config1 = BertConfig.from_json_file(args.bert_config_file1)
         model1 = BertModel(bert_config1)
         if args.init_checkpoint is not None:
-            model1.load_state_dict(torch.load(args.init_checkpoint1, map_location='cpu'))
+            state = torch.load(args.init_checkpoint1, map_location='cpu')
+            model1.load_state_dict(state)
+            del state
         model1.to(device)
         assert bert_config.hidden_size == bert_config1.hidden_size
+        # the BERT models are frozen unless fine-tuned, run them in half precision
+        # and cast their outputs back to fp32 for the mapping
+        if getattr(args, 'fp16', False) and device.type == 'cuda' and args.map_type != 'fine_tune' \
+                and not getattr(args, 'map_input', False):
+            half_bert(model)
+            half_bert(model1)
 
     # mapping
     #if args.non_linear:
@@ -100,21 +123,29 @@ def build_model(args, with_dis):
         logger.info("Linear mapping:\nEmbedding Dimension:{}".format(args.emb_dim))
         mapping = nn.Linear(args.emb_dim, args.emb_dim, bias=False)
         if getattr(args, 'map_id_init', True):
-            mapping.weight.data.copy_(torch.diag(torch.ones(args.emb_dim)))
+            torch.eye(args.emb_dim, out=mapping.weight.data)
     else:
         raise ValueError("Invalid map type: {}".format(args.map_type))
         exit(1)
     if mapping:
         mapping.to(device)
 
-    if args.local_rank != -1 and not args.load_pred_bert:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
-                                                          output_device=args.local_rank)
+    if args.local_rank != -1 and not args.no_cuda:
+        if not args.load_pred_bert:
+            model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
+                                                              output_device=args.local_rank)
+        # the mapping is a single small module, only replicate it when its
+        # gradients have to be synchronized, i.e. when it is trained with SGD/Adam
+        mapping_trained = not (getattr(args, 'pred', False) or getattr(args, 'eval', False)
+                               or args.map_type == 'svd')
+        if mapping and mapping_trained:
+            mapping = torch.nn.parallel.DistributedDataParallel(mapping, device_ids=[args.local_rank],
+                                                                output_device=args.local_rank)
     elif n_gpu > 1:
         if not args.load_pred_bert:
             model = torch.nn.DataParallel(model)
             model1 = torch.nn.DataParallel(model1)
-        if mapping:
-            mapping = torch.nn.DataParallel(mapping)
+        # the mapping stays on the output device of the BERT models, replicating
+        # it would broadcast its weights to every GPU on each forward
 
     return model, model1, mapping
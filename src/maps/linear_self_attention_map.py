@@ -21,7 +21,7 @@ class LinearSelfAttentionMap(nn.Module):
         logger.info("Linear mapping:\nEmbedding Dimension:{}".format(args.emb_dim))
         self.linear_map = nn.Linear(args.emb_dim, args.emb_dim, bias=False)
         if getattr(args, 'map_id_init', True):
-            self.linear_map.weight.data.copy_(torch.diag(torch.ones(args.emb_dim)))
+            torch.eye(args.emb_dim, out=self.linear_map.weight.data)
         self.self_map = SelfAttentionMap(args)
 
     def forward(self, input_tensor, attention_mask=None):
@@ -60,7 +60,7 @@ def build_model(params, with_dis):
     # mapping
     mapping = nn.Linear(params.emb_dim, params.emb_dim, bias=False)
     if getattr(params, 'map_id_init', True):
-        mapping.weight.data.copy_(torch.diag(torch.ones(params.emb_dim)))
+        torch.eye(params.emb_dim, out=mapping.weight.data)
 
     # discriminator
     discriminator = Discriminator(params) if with_dis else None
@@ -111,7 +111,7 @@ def build_supervised_model(params, with_dis):
     else:
         mapping = nn.Linear(params.emb_dim, params.emb_dim, bias=False)
         if getattr(params, 'map_id_init', True):
-            mapping.weight.data.copy_(torch.diag(torch.ones(params.emb_dim)))
+            torch.eye(params.emb_dim, out=mapping.weight.data)
 
     # discriminator
     discriminator = Discriminator(params) if with_dis else None
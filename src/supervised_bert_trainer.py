@@ -7,8 +7,6 @@
 
 import os
 from logging import getLogger
-import scipy
-import scipy.linalg
 import torch
 from torch.autograd import Variable
 from torch.nn import functional as F
@@ -19,6 +17,9 @@ from src.evaluation.word_translation import DIC_EVAL_PATH, load_identical_char_d
 
 logger = getLogger()
 
+# wrappers whose underlying model is reached through `.module`
+PARALLEL_MODULES = (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)
+
 class SupervisedBertTrainer(object):
 
     def __init__(self, bert_model, mapping, args, bert_model1=None,
@@ -36,6 +37,13 @@ class SupervisedBertTrainer(object):
             self.device = torch.device("cuda" if torch.cuda.is_available() and not self.args.no_cuda else "cpu")
         else:
             self.device = torch.device("cuda", self.args.local_rank)
+        # device of the linear mapping applied to loaded BERT, which runs on GPU
+        # even when the embeddings are kept on CPU (e.g. SVD on big data)
+        if str(self.device) == 'cpu' and torch.cuda.is_available():
+            self.map_device = torch.device("cuda")
+        else:
+            self.map_device = self.device
+        self.mapping_on_map_device = self.map_device == self.device
 
         # optimizers
         if hasattr(args, 'map_optimizer'):
@@ -61,16 +69,18 @@ class SupervisedBertTrainer(object):
 
         # normalization
         if self.args.normalize_embed:
-            src_emb = src_emb / src_emb.norm(2, 1, keepdim=True).expand_as(src_emb)
-            tgt_emb = tgt_emb / tgt_emb.norm(2, 1, keepdim=True).expand_as(tgt_emb)
+            src_emb = F.normalize(src_emb, p=2, dim=1)
+            tgt_emb = F.normalize(tgt_emb, p=2, dim=1)
         # (n, n)
         #scores = src_emb.mm(tgt_emb.transpose(0, 1))
         #rang = torch.arange(scores.shape[0], out=torch.LongTensor())
         #gold_scores = scores[rang, rang]
         
+        # (n) dot products of aligned pairs, shared by the losses and avg_cos_sim
+        dot = None
         if self.args.loss == 'cos_sim':
             # (n)
-            gold_scores = (src_emb * tgt_emb).sum(1)
+            gold_scores = dot = (src_emb * tgt_emb).sum(1)
             # maximize cosine similarities
             loss = - gold_scores.mean()
         elif self.args.loss == 'l2_dist':
@@ -80,35 +90,33 @@ class SupervisedBertTrainer(object):
             loss = (sub * sub).sum(1).mean()
         elif self.args.loss.startswith('max_margin_top'):
             # (n)
-            gold_scores = (src_emb * tgt_emb).sum(1)
+            gold_scores = dot = (src_emb * tgt_emb).sum(1)
             # (n, n)
             scores = src_emb.mm(tgt_emb.transpose(0, 1))
             # max margin with top k elements
             k = int(self.args.loss.split('-')[1])
             # (n, k)
             top_vals, top_ids = scores.topk(k, 1, True)
-            # (n) => (n, k)
-            gold_vals = gold_scores.unsqueeze(1).expand_as(top_vals)
-            # (n, k)
-            margins = torch.ones_like(top_vals) * margin
-            # (n, k)
-            losses = margins - gold_vals + top_vals
-            # mask out less than 0
-            losses = torch.where(losses>0, losses, torch.zeros_like(losses))
-            # ()
-            loss = losses.mean()
+            # (n, k) hinge on margin - gold + top, broadcasting gold over k => ()
+            loss = (top_vals - gold_scores.unsqueeze(1) + margin).clamp(min=0).mean()
 
         # check NaN
-        if (loss != loss).data.any():
+        if torch.isnan(loss):
             logger.error("NaN detected (supervised learning)")
             exit()
 
         # calculating average cosine similarity
         if not self.args.normalize_embed:
-            src_emb = src_emb / src_emb.norm(2, 1, keepdim=True).expand_as(src_emb)
-            tgt_emb = tgt_emb / tgt_emb.norm(2, 1, keepdim=True).expand_as(tgt_emb)
-        # (n)
-        avg_cos_sim = (src_emb * tgt_emb).sum(1).mean()
+            # divide by the row norms instead of normalizing copies of the
+            # embeddings, which callers such as svd() keep using afterwards
+            with torch.no_grad():
+                # (n)
+                norms = src_emb.norm(2, 1).clamp(min=1e-12) * tgt_emb.norm(2, 1).clamp(min=1e-12)
+                dot = (src_emb * tgt_emb).sum(1) / norms
+        elif dot is None:
+            # (n)
+            dot = (src_emb * tgt_emb).sum(1)
+        avg_cos_sim = dot.mean()
 
         if eval_only:
             return avg_cos_sim, loss
@@ -130,7 +138,8 @@ class SupervisedBertTrainer(object):
             else:
                 self.bert_model1.eval()
                 all_encoder_layers, _ = self.bert_model1(input_ids, token_type_ids=None, attention_mask=input_mask)
-            encoder_layer = all_encoder_layers[bert_layer]
+            # no-op unless BERT runs in half precision
+            encoder_layer = all_encoder_layers[bert_layer].float()
         # [batch_size, seq_len, output_dim]
         return encoder_layer
 
@@ -146,35 +155,23 @@ class SupervisedBertTrainer(object):
         # [batch_size, seq_len, output_dim]
         return encoder_layer
 
-    def select(self, layer, mask):
+    def gather_selected(self, layer, index, align_mask):
         """
-        Select all unmasked embed in this batch
+        Rearange layer by index and select the aligned embeddings in one gather
         Inputs:
-            layer [batch_size, seq_len, output_dim]
-            mask [batch_size, seq_len] of 0/1
-        Outputs:
-            masked_layer [unmasked_len, output_dim]
-        """
-        batch_size, seq_len, output_dim = list(layer.size())
-        # [batch_size, seq_len, output_dim] => [unmasked_len, output_dim]
-        return layer.masked_select(mask.byte().view(batch_size, seq_len, 1).expand(-1, -1, output_dim)).view(-1,output_dim)
-
-    def rearange(self, layer, index):
-        """
-        Rearange layer by index
-        Inputs: 
             layer [batch_size, seq_len, output_dim]
             index [batch_size, max_align]
+            align_mask [batch_size, max_align] of 0/1
         Outputs:
-            rearanged_layer [batch_size, max_align, output_dim]
+            selected_layer [unmasked_len, output_dim]
         """
         batch_size, seq_len, output_dim = list(layer.size())
-        batch_size, max_align = list(index.size())
-        #[batch_size, max_align]=>[batch_size, max_align, output_dim]
-        expanded_index = index.view(batch_size, max_align, 1).expand(-1,-1,output_dim)
-        #[batch_size, max_align, output_dim]
-        rearanged_layer = layer.gather(1, expanded_index)
-        return rearanged_layer
+        # [batch_size, 1] offset of each sentence in the flattened layer
+        batch_offsets = (torch.arange(batch_size, device=layer.device) * seq_len).unsqueeze(1)
+        # [batch_size, max_align] => [unmasked_len]
+        flat_index = (index + batch_offsets)[align_mask.byte()]
+        # [batch_size * seq_len, output_dim] => [unmasked_len, output_dim]
+        return layer.reshape(batch_size * seq_len, output_dim).index_select(0, flat_index)
 
     def get_indexed_mapped_bert(self, input_ids, input_mask, index, align_mask, bert_layer=-1, model_id=0):
         """
@@ -190,9 +187,8 @@ class SupervisedBertTrainer(object):
             mapped_bert = unmasked_bert
         else:
             mapped_bert = self.mapping(unmasked_bert)
-        rearanged_bert = self.rearange(mapped_bert, index)
-        indexed_bert = self.select(rearanged_bert, align_mask)
-        #print (unmasked_bert, '\n', mapped_bert, '\n', rearanged_bert, '\n', indexed_bert)
+        indexed_bert = self.gather_selected(mapped_bert, index, align_mask)
+        #print (unmasked_bert, '\n', mapped_bert, '\n', indexed_bert)
         return indexed_bert
 
     def get_indexed_mapped_bert_from_bert(self, unmasked_bert, input_mask, index, align_mask, bert_layer=-1):
@@ -204,17 +200,17 @@ class SupervisedBertTrainer(object):
         elif self.args.map_type == 'fine_tune':
             mapped_bert = unmasked_bert
         else:
-            if str(self.device) == 'cpu':
-              print ("Transfering to gpu")
-              unmasked_bert = unmasked_bert.cuda()
-              self.mapping = self.mapping.cuda()
-            mapped_bert = self.mapping(unmasked_bert)
-            if str(self.device) == 'cpu':
-              print ("Trnasfering back to cpu")
-              mapped_bert = mapped_bert.cpu()
-        rearanged_bert = self.rearange(mapped_bert, index)
-        indexed_bert = self.select(rearanged_bert, align_mask)
-        #print (unmasked_bert, '\n', mapped_bert, '\n', rearanged_bert, '\n', indexed_bert)
+            if self.map_device != self.device:
+                if not self.mapping_on_map_device:
+                    logger.info("Transfering mapping to %s" % self.map_device)
+                    self.mapping = self.mapping.to(self.map_device)
+                    self.mapping_on_map_device = True
+                unmasked_bert = unmasked_bert.to(self.map_device, non_blocking=True)
+                mapped_bert = self.mapping(unmasked_bert).to(self.device)
+            else:
+                mapped_bert = self.mapping(unmasked_bert)
+        indexed_bert = self.gather_selected(mapped_bert, index, align_mask)
+        #print (unmasked_bert, '\n', mapped_bert, '\n', indexed_bert)
         return indexed_bert
 
     def get_indexed_bert(self, input_ids, input_mask, index, align_mask, bert_layer=-1, model_id=1):
@@ -222,16 +218,14 @@ class SupervisedBertTrainer(object):
         Get bert according to index and align_mask
         """
         unmasked_bert = self.get_unmasked_bert(input_ids, input_mask, bert_layer, model_id)
-        rearanged_bert = self.rearange(unmasked_bert, index)
-        indexed_bert = self.select(rearanged_bert, align_mask)
+        indexed_bert = self.gather_selected(unmasked_bert, index, align_mask)
         return indexed_bert
 
     def get_indexed_bert_from_bert(self, unmasked_bert, index, align_mask, bert_layer=-1):
         """
         Get bert according to index and align_mask
         """
-        rearanged_bert = self.rearange(unmasked_bert, index)
-        indexed_bert = self.select(rearanged_bert, align_mask)
+        indexed_bert = self.gather_selected(unmasked_bert, index, align_mask)
         return indexed_bert
 
     def procrustes(self, src_embs, tgt_embs):
@@ -243,13 +237,14 @@ class SupervisedBertTrainer(object):
         """
         A = src_embs
         B = tgt_embs
-        if isinstance(self.mapping, torch.nn.DataParallel):
+        if isinstance(self.mapping, PARALLEL_MODULES):
             W = self.mapping.module.weight.data
         else:
             W = self.mapping.weight.data
-        M = B.transpose(0, 1).mm(A).cpu().numpy()
-        U, S, V_t = scipy.linalg.svd(M, full_matrices=True)
-        W.copy_(torch.from_numpy(U.dot(V_t)).type_as(W))
+        M = B.transpose(0, 1).mm(A)
+        # SVD on the device holding the embeddings, M = U diag(S) V^T
+        U, S, V = torch.svd(M)
+        W.copy_(U.mm(V.t()))
         logger.info("Finished Procrustes.")
 
     def decay_map_lr(self):
@@ -280,19 +275,22 @@ class SupervisedBertTrainer(object):
         """
         Save model to path.
         """
+        # only the first process of a distributed launch writes the model
+        if self.args.local_rank > 0:
+            return
         if not os.path.exists(os.path.dirname(path)):
             os.makedirs(os.path.dirname(path))
 
         if self.args.map_type == 'fine_tune':
             logger.info('* Saving the src BERT model to %s ...' % path)
-            if isinstance(self.bert_model, torch.nn.DataParallel):
+            if isinstance(self.bert_model, PARALLEL_MODULES):
                 torch.save(self.bert_model.module.state_dict(), path)
             else:
                 torch.save(self.bert_model.state_dict(), path)
             return
 
         logger.info('* Saving the mapping to %s ...' % path)
-        if isinstance(self.mapping, torch.nn.DataParallel):
+        if isinstance(self.mapping, PARALLEL_MODULES):
             torch.save(self.mapping.module.state_dict(), path)
         else:
             torch.save(self.mapping.state_dict(), path)
@@ -311,7 +309,7 @@ class SupervisedBertTrainer(object):
         """
         load model from path
         """
-        if isinstance(self.mapping, torch.nn.DataParallel):
+        if isinstance(self.mapping, PARALLEL_MODULES):
             self.mapping.module.load_state_dict(
                 torch.load(path, map_location=lambda storage, loc: storage))
         else:
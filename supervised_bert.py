@@ -12,6 +12,7 @@ import argparse
 from collections import OrderedDict
 import numpy as np
 import torch
+from logging import getLogger, WARNING
 import string
 
 from src.utils import bool_flag, initialize_exp
@@ -21,6 +22,7 @@ from src.supervised_bert_trainer import SupervisedBertTrainer
 from src.bert_evaluator import BertEvaluator
 from src.bert_evaluator import load_stop_words, rm_stop_words, cos_sim, get_overlaps, get_overlap_sim
 from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler
+from torch.utils.data.distributed import DistributedSampler
 from torch.utils.data.dataloader import _DataLoaderIter
 
 def main():
@@ -75,6 +77,7 @@ def main():
                             "models and False for cased models.")
     parser.add_argument("--local_rank",type=int, default=-1, help = "local_rank for distributed training on gpus")
     parser.add_argument("--no_cuda", default=False, action='store_true', help="Whether not to use CUDA when available")
+    parser.add_argument("--fp16", default=False, action='store_true', help="Whether to run the frozen BERT models in half precision on GPU")
     parser.add_argument("--rm_stop_words", default=False, action='store_true', help="Whether to remove stop words while evaluating(sentence similarity)")
     parser.add_argument("--rm_punc", default=False, action='store_true', help="Whether to remove punctuation while evaluating(sentence similarity)")
     parser.add_argument("--stop_words_src", type=str, default="", help="Stop word file for source language")
@@ -182,7 +185,13 @@ class SupervisedBert(object):
         self.dataset = None
         # build model / trainer / evaluator
         if not (self.args.pred or self.args.eval):
-            self.logger = initialize_exp(self.args)
+            # only the first process of a distributed launch creates the
+            # experiment directory and logs, the others just report warnings
+            if self.args.local_rank <= 0:
+                self.logger = initialize_exp(self.args)
+            else:
+                self.logger = getLogger('rank{}'.format(self.args.local_rank))
+                self.logger.setLevel(WARNING)
 
         self.bert_model, self.bert_model1, self.mapping = build_model(self.args, True)
 
@@ -214,20 +223,26 @@ class SupervisedBert(object):
         self.trainer = SupervisedBertTrainer(self.bert_model, self.mapping, 
                                     self.args, bert_model1=self.bert_model1, trans_types=self.transformer_types)
 
-        sampler = RandomSampler(self.dataset)
-        train_loader = DataLoader(self.dataset, sampler=sampler, batch_size=self.args.batch_size)
+        if self.args.local_rank == -1 or self.args.no_cuda:
+            sampler = RandomSampler(self.dataset)
+        else:
+            sampler = DistributedSampler(self.dataset)
+        train_loader = DataLoader(self.dataset, sampler=sampler, batch_size=self.args.batch_size,
+                                 pin_memory=self.device.type == 'cuda')
 
         n_without_improvement = 0
         min_loss = 1e6
         path4loss = self.args.model_path + '/model4loss'
-        if not os.path.exists(path4loss):
+        if self.args.local_rank <= 0 and not os.path.exists(path4loss):
             os.makedirs(path4loss)
-        if self.args.save_all:
+        if self.args.save_all and self.args.local_rank <= 0:
             model_log = open(path4loss+'/model.log', 'w')
 
         # training loop
         for n_epoch in range(self.args.n_epochs):
             #self.logger.info('Starting epoch %i...' % n_epoch)
+            if isinstance(sampler, DistributedSampler):
+                sampler.set_epoch(n_epoch)
             if (n_epoch+1) % self.args.decay_step == 0:
                 self.trainer.decay_map_lr()
             n_inst = 0
@@ -238,12 +253,12 @@ class SupervisedBert(object):
                 for input_embs_a, input_mask_a, input_embs_b, input_mask_b, align_ids_a, align_ids_b, align_mask, example_indices in train_loader:
                     n_batch += 1
                     with torch.no_grad():
-                        input_embs_a = input_embs_a.to(self.device)
-                        input_mask_a = input_mask_a.to(self.device)
-                        input_embs_b = input_embs_b.to(self.device)
-                    align_ids_a = align_ids_a.to(self.device)
-                    align_ids_b = align_ids_b.to(self.device)
-                    align_mask = align_mask.to(self.device)
+                        input_embs_a = input_embs_a.to(self.device, non_blocking=True)
+                        input_mask_a = input_mask_a.to(self.device, non_blocking=True)
+                        input_embs_b = input_embs_b.to(self.device, non_blocking=True)
+                    align_ids_a = align_ids_a.to(self.device, non_blocking=True)
+                    align_ids_b = align_ids_b.to(self.device, non_blocking=True)
+                    align_mask = align_mask.to(self.device, non_blocking=True)
                     #print (align_ids_a, align_ids_b, align_mask)
                     src_bert = self.trainer.get_indexed_mapped_bert_from_bert(
                                     input_embs_a, input_mask_a, align_ids_a, align_mask, 
@@ -262,13 +277,13 @@ class SupervisedBert(object):
             else:
                 for input_ids_a, input_mask_a, input_ids_b, input_mask_b, align_ids_a, align_ids_b, align_mask, example_indices in train_loader:
                     n_batch += 1
-                    input_ids_a = input_ids_a.to(self.device)
-                    input_mask_a = input_mask_a.to(self.device)
-                    input_ids_b = input_ids_b.to(self.device)
-                    input_mask_b = input_mask_b.to(self.device)
-                    align_ids_a = align_ids_a.to(self.device)
-                    align_ids_b = align_ids_b.to(self.device)
-                    align_mask = align_mask.to(self.device)
+                    input_ids_a = input_ids_a.to(self.device, non_blocking=True)
+                    input_mask_a = input_mask_a.to(self.device, non_blocking=True)
+                    input_ids_b = input_ids_b.to(self.device, non_blocking=True)
+                    input_mask_b = input_mask_b.to(self.device, non_blocking=True)
+                    align_ids_a = align_ids_a.to(self.device, non_blocking=True)
+                    align_ids_b = align_ids_b.to(self.device, non_blocking=True)
+                    align_mask = align_mask.to(self.device, non_blocking=True)
                     #print (align_ids_a, align_ids_b, align_mask)
                     src_bert = self.trainer.get_indexed_mapped_bert(
                                     input_ids_a, input_mask_a, align_ids_a, align_mask, 
@@ -284,6 +299,14 @@ class SupervisedBert(object):
 
                     to_log["avg_cosine_similarity"] += cos_sim
                     to_log["loss"] += loss_
+            if isinstance(sampler, DistributedSampler):
+                # average over all shards so every process takes the same
+                # early stopping and saving decisions
+                epoch_stats = torch.tensor([float(to_log["avg_cosine_similarity"]), float(to_log["loss"]),
+                                            n_batch, n_inst], device=self.device)
+                torch.distributed.all_reduce(epoch_stats)
+                to_log["avg_cosine_similarity"], to_log["loss"], n_batch, n_inst = epoch_stats.tolist()
+                n_inst = int(n_inst)
             to_log["avg_cosine_similarity"] /= n_batch
             to_log["loss"] /= n_batch
             self.logger.info("Epoch:{}, avg cos sim:{:.6f}, avg loss:{:.6f}, instances:{}".format(n_epoch, to_log["avg_cosine_similarity"], to_log["loss"], n_inst))
@@ -296,8 +319,9 @@ class SupervisedBert(object):
                 self.logger.info(" Minimum loss : {:.6f}".format(to_log["loss"]))
                 if self.args.save_all:
                     save_path = path4loss+'/epoch-'+str(n_epoch)
-                    model_log.write("Epoch:{}, avg cos sim:{:.6f}, avg loss:{:.6f}\n".format(n_epoch, 
-                                    to_log["avg_cosine_similarity"], to_log["loss"]))
+                    if self.args.local_rank <= 0:
+                        model_log.write("Epoch:{}, avg cos sim:{:.6f}, avg loss:{:.6f}\n".format(n_epoch, 
+                                        to_log["avg_cosine_similarity"], to_log["loss"]))
                 else:
                     save_path = path4loss
                 self.trainer.save_model(save_path+'/best_mapping.pkl')
@@ -337,12 +361,12 @@ class SupervisedBert(object):
         for input_embs_a, input_mask_a, input_embs_b, input_mask_b, align_ids_a, align_ids_b, align_mask, example_indices in train_loader:
             self.logger.info("Applying SVD")
             with torch.no_grad():
-                input_embs_a = input_embs_a.to(self.device)
-                input_mask_a = input_mask_a.to(self.device)
-                input_embs_b = input_embs_b.to(self.device)
-            align_ids_a = align_ids_a.to(self.device)
-            align_ids_b = align_ids_b.to(self.device)
-            align_mask = align_mask.to(self.device)
+                input_embs_a = input_embs_a.to(self.device, non_blocking=True)
+                input_mask_a = input_mask_a.to(self.device, non_blocking=True)
+                input_embs_b = input_embs_b.to(self.device, non_blocking=True)
+            align_ids_a = align_ids_a.to(self.device, non_blocking=True)
+            align_ids_b = align_ids_b.to(self.device, non_blocking=True)
+            align_mask = align_mask.to(self.device, non_blocking=True)
             #print (align_ids_a, align_ids_b, align_mask)
             src_bert = self.trainer.get_indexed_bert_from_bert(
                             input_embs_a, align_ids_a, align_mask, 
@@ -383,7 +407,8 @@ class SupervisedBert(object):
         self.trainer.mapping.eval()
 
         sampler = SequentialSampler(self.dataset)
-        train_loader = DataLoader(self.dataset, sampler=sampler, batch_size=self.args.batch_size)
+        train_loader = DataLoader(self.dataset, sampler=sampler, batch_size=self.args.batch_size,
+                                 pin_memory=self.device.type == 'cuda')
 
         n_inst = 0
         n_batch = 0
@@ -393,12 +418,12 @@ class SupervisedBert(object):
         for input_embs_a, input_mask_a, input_embs_b, input_mask_b, align_ids_a, align_ids_b, align_mask, example_indices in train_loader:
             n_batch += 1
             with torch.no_grad():
-                input_embs_a = input_embs_a.to(self.device)
-                input_mask_a = input_mask_a.to(self.device)
-                input_embs_b = input_embs_b.to(self.device)
-            align_ids_a = align_ids_a.to(self.device)
-            align_ids_b = align_ids_b.to(self.device)
-            align_mask = align_mask.to(self.device)
+                input_embs_a = input_embs_a.to(self.device, non_blocking=True)
+                input_mask_a = input_mask_a.to(self.device, non_blocking=True)
+                input_embs_b = input_embs_b.to(self.device, non_blocking=True)
+            align_ids_a = align_ids_a.to(self.device, non_blocking=True)
+            align_ids_b = align_ids_b.to(self.device, non_blocking=True)
+            align_mask = align_mask.to(self.device, non_blocking=True)
             #print (align_ids_a, align_ids_b, align_mask)
             src_bert = self.trainer.get_indexed_mapped_bert_from_bert(
                             input_embs_a, input_mask_a, align_ids_a, align_mask, 
@@ -438,14 +463,15 @@ class SupervisedBert(object):
                         local_rank=self.args.local_rank)
             self.bert_model.eval()
         pred_sampler = SequentialSampler(pred_dataset)
-        pred_dataloader = DataLoader(pred_dataset, sampler=pred_sampler, batch_size=self.args.batch_size)
+        pred_dataloader = DataLoader(pred_dataset, sampler=pred_sampler, batch_size=self.args.batch_size,
+                                    pin_memory=self.device.type == 'cuda')
  
         self.trainer.mapping.eval()
         with open(self.args.output_file, "w", encoding='utf-8') as writer:
             if self.args.load_pred_bert:
                 for input_embs, input_mask, example_indices in pred_dataloader:
-                    input_embs = input_embs.to(self.device)
-                    input_mask = input_mask.to(self.device)
+                    input_embs = input_embs.to(self.device, non_blocking=True)
+                    input_mask = input_mask.to(self.device, non_blocking=True)
 
                     src_encoder_layer = input_embs
                     if self.args.map_type in self.transformer_types:
@@ -480,8 +506,8 @@ class SupervisedBert(object):
                         writer.write(json.dumps(output_json) + "\n")
             else:
                 for input_ids, input_mask, example_indices in pred_dataloader:
-                    input_ids = input_ids.to(self.device)
-                    input_mask = input_mask.to(self.device)
+                    input_ids = input_ids.to(self.device, non_blocking=True)
+                    input_mask = input_mask.to(self.device, non_blocking=True)
 
                     if self.args.map_input:
                         all_encoder_layers, _ = self.bert_model(input_ids, token_type_ids=None, 
@@ -490,7 +516,7 @@ class SupervisedBert(object):
                     else:
                         all_encoder_layers, _ = self.bert_model(input_ids, token_type_ids=None,
                                                     attention_mask=input_mask)
-                        src_encoder_layer = all_encoder_layers[self.args.bert_layer]
+                        src_encoder_layer = all_encoder_layers[self.args.bert_layer].float()
                         if self.args.map_type in self.transformer_types:
                             target_layer = self.trainer.mapping(src_encoder_layer, input_mask)
                         elif self.args.map_type == 'fine_tune':
@@ -535,13 +561,14 @@ class SupervisedBert(object):
         assert self.args.bert_file0 is not None
         pred_dataset, unique_id_to_feature, features = load_from_single_bert(self.args.bert_file0, max_seq_length=self.args.max_seq_length)
         pred_sampler = SequentialSampler(pred_dataset)
-        pred_dataloader = DataLoader(pred_dataset, sampler=pred_sampler, batch_size=self.args.batch_size)
+        pred_dataloader = DataLoader(pred_dataset, sampler=pred_sampler, batch_size=self.args.batch_size,
+                                    pin_memory=self.device.type == 'cuda')
  
         self.trainer.mapping.eval()
         with open(self.args.output_file, "w", encoding='utf-8') as writer:
             for input_embs, input_mask, example_indices in pred_dataloader:
-                input_embs = input_embs.to(self.device)
-                input_mask = input_mask.to(self.device)
+                input_embs = input_embs.to(self.device, non_blocking=True)
+                input_mask = input_mask.to(self.device, non_blocking=True)
 
                 src_encoder_layer = input_embs
                 if self.args.map_type in self.transformer_types: